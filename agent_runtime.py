@@ -0,0 +1,698 @@
+"""Agent runtime: the MiMo model, search tools, caches and the compiled graph.
+
+Everything expensive (model clients, embedder, caches, the compiled graph) is created
+lazily by a cached getter, so it is built once per process on first use and then
+shared. Call get_app() from inside the running event loop.
+"""
+import os
+import time
+import platform
+import uuid
+import asyncio
+import threading
+import functools
+from typing import Annotated, TypedDict
+from dotenv import load_dotenv
+import httpx
+import orjson
+import faiss
+import numpy as np
+import aiosqlite
+import diskcache
+import onnxruntime as ort
+from blake3 import blake3
+from cachetools import LRUCache, TTLCache
+from huggingface_hub import hf_hub_download
+from tokenizers import Tokenizer
+
+# 1. THE BRAIN & LOGIC IMPORTS
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage, SystemMessage
+from langchain_core.messages import message_chunk_to_message, get_buffer_string
+from langchain_core.tools import BaseTool, StructuredTool
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.message import add_messages
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+# 2. THE HANDS (TOOLS)
+from ddgs import DDGS
+
+load_dotenv()
+
+# --- INITIALIZATION ---
+# MiMo gets its own HTTP/2 client, so concurrent LLM calls (batch mode, tool rounds)
+# multiplex over one connection. warm_up() opens that connection at startup, so the
+# first question doesn't also pay for DNS + TLS.
+@functools.lru_cache(maxsize=1)
+def get_llm_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+        timeout=60,
+    )
+
+# This sets up your MiMo model
+@functools.lru_cache(maxsize=1)
+def get_llm() -> ChatOpenAI:
+    return ChatOpenAI(
+        model="mimo-v2-flash",
+        api_key=os.getenv("MIMO_API_KEY"),
+        base_url=os.getenv("MIMO_BASE_URL"),
+        http_async_client=get_llm_http_client(),
+        # tiktoken doesn't know MiMo; borrow a close encoding so token budgets can be estimated
+        tiktoken_model_name="gpt-4o",
+    )
+
+async def warm_up():
+    """Open the pooled connection to the MiMo endpoint with a cheap GET /models."""
+    base_url = os.getenv("MIMO_BASE_URL")
+    if not base_url:
+        return
+    try:
+        await get_llm_http_client().get(
+            f"{base_url.rstrip('/')}/models",
+            headers={"Authorization": f"Bearer {os.getenv('MIMO_API_KEY')}"},
+        )
+    except httpx.HTTPError:
+        pass  # best effort: the first real call will simply connect itself
+
+@functools.lru_cache(maxsize=1)
+def get_llm_with_tools():
+    # A single search tool: the graph sends every call to both providers anyway
+    return get_llm().bind_tools([WEB_SEARCH_TOOL])
+
+# --- SEARCH CLIENTS ---
+# One shared async HTTP client for all Tavily calls: keep-alive + HTTP/2 means the
+# TCP/TLS handshake is paid once, not on every search. Never create one per call.
+TAVILY_URL = "https://api.tavily.com/search"
+TAVILY_MAX_RESULTS = 3
+DDG_MAX_RESULTS = 5
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+        timeout=10,
+    )
+
+async def async_tavily_search(query: str) -> list[dict]:
+    """Search the web with Tavily. Returns the top results as {url, content} dicts."""
+    # orjson encodes/decodes straight from bytes, skipping the stdlib json round-trip
+    response = await get_http_client().post(
+        TAVILY_URL,
+        headers={
+            "Authorization": f"Bearer {os.getenv('TAVILY_API_KEY')}",
+            "Content-Type": "application/json",
+        },
+        content=orjson.dumps({"query": query, "max_results": TAVILY_MAX_RESULTS}),
+    )
+    response.raise_for_status()
+    return [
+        {"url": r["url"], "content": r["content"]}
+        for r in orjson.loads(response.content).get("results", [])
+    ]
+
+# The ddgs client is synchronous, so it runs in a worker thread. A single instance is
+# reused so its HTTP session (and connections) are shared across searches.
+@functools.lru_cache(maxsize=1)
+def get_ddgs() -> DDGS:
+    return DDGS()
+
+async def async_ddg_search(query: str) -> str:
+    """Search the web with DuckDuckGo. Returns the top result snippets."""
+    # Pin the DuckDuckGo backend; ddgs otherwise picks among several search engines
+    results = await asyncio.to_thread(
+        get_ddgs().text, query, max_results=DDG_MAX_RESULTS, backend="duckduckgo"
+    )
+    return "\n\n".join(f"{r['title']}: {r['body']} ({r['href']})" for r in results)
+
+# --- SEARCH CACHE ---
+# Search tools are read-only, so repeating a query can reuse the earlier result.
+# Results live in an in-memory TTL LRU, backed by a disk cache so they survive restarts.
+SEARCH_CACHE_DIR = "./.search_cache"
+SEARCH_CACHE_TTL = 900  # seconds
+_MISS = object()
+
+class SearchCache:
+    """Two-level (memory + disk) cache for search results, with hit/miss counters."""
+
+    def __init__(self, directory: str, maxsize: int = 1024, ttl: int = SEARCH_CACHE_TTL):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = diskcache.Cache(directory)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self.memory.get(key, _MISS)
+        if value is _MISS:
+            value = self.disk.get(key, default=_MISS)  # expired entries count as missing
+            if value is not _MISS:
+                self.memory[key] = value
+        if value is _MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        self.memory[key] = value
+        self.disk.set(key, value, expire=self.ttl)
+
+@functools.lru_cache(maxsize=1)
+def get_search_cache() -> SearchCache:
+    return SearchCache(SEARCH_CACHE_DIR)
+
+def cached_search(tool: BaseTool, cache: SearchCache) -> BaseTool:
+    """Wrap a search tool so results are cached on the normalized query."""
+    async def search(query: str):
+        key = f"{tool.name}:{' '.join(query.lower().split())}"
+        result = cache.get(key)
+        if result is _MISS:
+            result = await tool.ainvoke({"query": query})
+            cache.set(key, result)
+        return result
+
+    # Same name/description/schema as the wrapped tool, so the LLM sees no difference
+    return StructuredTool.from_function(
+        coroutine=search,
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+    )
+
+@functools.lru_cache(maxsize=1)
+def get_search_tools() -> dict[str, BaseTool]:
+    """The cached search tools, keyed by provider label."""
+    tavily = StructuredTool.from_function(
+        coroutine=async_tavily_search,
+        name="tavily_search_results_json",
+        description=(
+            "A search engine optimized for comprehensive, accurate, and trusted results. "
+            "Useful for when you need to answer questions about current events. "
+            "Input should be a search query."
+        ),
+    )
+    ddg = StructuredTool.from_function(
+        coroutine=async_ddg_search,
+        name="duckduckgo_search",
+        description=(
+            "A wrapper around DuckDuckGo Search. Useful for when you need to answer "
+            "questions about current events. Input should be a search query."
+        ),
+    )
+    cache = get_search_cache()
+    return {"Tavily": cached_search(tavily, cache), "DuckDuckGo": cached_search(ddg, cache)}
+
+# The only tool the model sees. Its calls are never invoked as such: should_continue
+# sends each one to every provider in PROVIDERS, and merge_results joins the answers.
+WEB_SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "web_search",
+        "description": (
+            "Search the web with Tavily and DuckDuckGo in parallel and get both result "
+            "sets. Useful for when you need to answer questions about current events "
+            "or facts you are unsure about."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {"query": {"type": "string", "description": "The search query"}},
+            "required": ["query"],
+        },
+    },
+}
+
+# --- SEMANTIC CACHE ---
+# Near-identical questions reuse a previous answer instead of calling MiMo again.
+# Questions are embedded with a small sentence model; vectors are normalized,
+# so inner product == cosine similarity.
+#
+# Both the model and the index run in int8: the embedder is the int8-quantized ONNX
+# export of all-MiniLM-L6-v2 on onnxruntime with the standalone `tokenizers` library
+# (no PyTorch or transformers needed), and the index stores 8-bit scalar-quantized
+# vectors. That is ~4x less memory than float32 and uses the CPU's int8 dot-product
+# instructions (VNNI) where available.
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+def pick_onnx_file() -> str:
+    """The quantized export (in the model repo's onnx/ folder) that suits this CPU."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as f:
+            if "avx512_vnni" in f.read():
+                return "model_qint8_avx512_vnni.onnx"
+    except OSError:
+        pass
+    # The u8s8 exports can saturate on x86 CPUs without VNNI; u8u8 is safe everywhere
+    return "model_quint8_avx2.onnx"
+
+EMBED_ONNX_FILE = pick_onnx_file()
+CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = SEARCH_CACHE_TTL  # answers may depend on fresh data
+
+class OnnxEmbedder:
+    """Sentence embeddings from a quantized ONNX model (mean pooling + L2 norm)."""
+
+    def __init__(self, model_name: str = EMBED_MODEL, file_name: str = EMBED_ONNX_FILE):
+        self.tokenizer = Tokenizer.from_pretrained(model_name)  # Rust-backed fast tokenizer
+        self.tokenizer.enable_padding()
+        self.tokenizer.enable_truncation(max_length=512)
+        model_path = hf_hub_download(model_name, f"onnx/{file_name}")
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """Return one normalized float32 vector per text."""
+        encodings = self.tokenizer.encode_batch(texts)
+        tokens = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        inputs = {k: v for k, v in tokens.items() if k in self.input_names}
+        hidden = self.session.run(None, inputs)[0]
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return (pooled / np.linalg.norm(pooled, axis=1, keepdims=True)).astype(np.float32)
+
+class SemanticCache:
+    """Final answers keyed by the embedding of the question that produced them."""
+
+    def __init__(self, threshold: float = CACHE_THRESHOLD, ttl: int = SEMANTIC_CACHE_TTL):
+        self.embedder = OnnxEmbedder()
+        d = self.embedder.dimension
+        # The id map lets expired entries be removed without renumbering the others
+        self.index = faiss.IndexIDMap(faiss.IndexScalarQuantizer(
+            d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        ))
+        # The quantizer needs a per-dimension range; unit vectors always lie in [-1, 1]
+        self.index.train(np.stack([-np.ones(d), np.ones(d)]).astype(np.float32))
+        self.store: dict[int, tuple[AIMessage, float]] = {}  # id -> (answer, created)
+        self.next_id = 0
+        self.threshold = threshold
+        self.ttl = ttl
+        # Recently computed embeddings, e.g. precomputed while the question was typed
+        self.recent = LRUCache(maxsize=64)
+
+    async def embed_async(self, text: str):
+        """Embed a normalized question (lowercased, whitespace collapsed).
+
+        Inference runs in a worker thread; the result is remembered, so embedding the
+        same text again (e.g. after pre-embedding) is instant.
+        """
+        normalized = " ".join(text.lower().split())
+        emb = self.recent.get(normalized)
+        if emb is None:
+            emb = await asyncio.to_thread(self.embedder.encode, [normalized])
+            self.recent[normalized] = emb
+        return emb
+
+    def lookup(self, emb):
+        """Return the cached answer for a similar question, or None."""
+        if self.index.ntotal == 0:
+            return None
+        scores, ids = self.index.search(emb, 1)
+        if scores[0, 0] <= self.threshold:
+            return None
+        entry_id = int(ids[0, 0])
+        response, created = self.store[entry_id]
+        if time.time() - created > self.ttl:
+            # Drop it, so the next answer to this question can take its place
+            self.index.remove_ids(np.array([entry_id], dtype=np.int64))
+            del self.store[entry_id]
+            return None
+        return response
+
+    def add(self, emb, response: AIMessage):
+        """Remember a final answer. Tool-call responses are never cached."""
+        if response.tool_calls:
+            return
+        self.store[self.next_id] = (response, time.time())
+        self.index.add_with_ids(emb, np.array([self.next_id], dtype=np.int64))
+        self.next_id += 1
+
+# Building the cache downloads and loads the model, so it runs in a worker thread
+# (see call_mimo). The cache is optional: if it can't be built (e.g. offline), the
+# failure is remembered and every lookup is simply a miss.
+_semantic_cache_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _build_semantic_cache() -> SemanticCache | None:
+    try:
+        return SemanticCache()
+    except Exception:
+        return None
+
+def get_semantic_cache() -> SemanticCache | None:
+    """The shared semantic cache, or None if it couldn't be built. Blocks while building."""
+    with _semantic_cache_lock:  # concurrent first callers wait for one build
+        return _build_semantic_cache()
+
+# --- EXACT PREFIX CACHE ---
+# Re-asking the same question replays the same trajectory: the same prompt leads to
+# the same tool call, the same (cached) search results, and so on. Each LLM response
+# is stored under a blake3 hash of the exact prompt, so an identical prompt gets its
+# answer back in O(1), with no embedding and no false positives. Entries are on disk
+# (diskcache, like search results) and expire with them, since answers may depend on
+# fresh data; expired entries are evicted, so the cache doesn't grow without bound.
+PREFIX_CACHE_DIR = "./.prefix_cache"
+PREFIX_CACHE_TTL = SEARCH_CACHE_TTL
+
+def prefix_key(prompt: list[BaseMessage]) -> str:
+    """Content hash of a prompt. Tool call ids are random per run, so they're left out."""
+    payload = [
+        (m.type, m.content, [(tc["name"], tc["args"]) for tc in getattr(m, "tool_calls", [])])
+        for m in prompt
+    ]
+    return blake3(orjson.dumps(payload)).hexdigest()
+
+class PrefixCache:
+    """LLM responses keyed by prefix_key(prompt), persisted with diskcache."""
+
+    def __init__(self, directory: str = PREFIX_CACHE_DIR, ttl: int = PREFIX_CACHE_TTL):
+        self.disk = diskcache.Cache(directory)
+        self.ttl = ttl
+
+    def get(self, key: str) -> AIMessage | None:
+        entry = self.disk.get(key)  # expired entries count as missing
+        if entry is None:
+            return None
+        # Fresh tool call ids, so a replayed call never clashes with an earlier one
+        tool_calls = [{**tc, "id": f"call_{uuid.uuid4().hex[:24]}"} for tc in entry["tool_calls"]]
+        return AIMessage(content=entry["content"], tool_calls=tool_calls)
+
+    def set(self, key: str, response: AIMessage):
+        self.disk.set(key, {
+            "content": response.content,
+            "tool_calls": [{"name": tc["name"], "args": tc["args"]} for tc in response.tool_calls],
+        }, expire=self.ttl)
+
+@functools.lru_cache(maxsize=1)
+def get_prefix_cache() -> PrefixCache:
+    return PrefixCache()
+
+# --- PROMPT LAYOUT ---
+# The prompt is [static system] -> [summary] -> [history]. History is append-only, so
+# as long as SYSTEM is static each prompt starts with the previous one byte for byte,
+# and the provider's automatic prefix cache can skip re-processing it. Keep SYSTEM
+# static: no dates or other per-call values in here.
+SYSTEM = SystemMessage(
+    content=(
+        "You are a research assistant. Use the search tool when a question needs "
+        "current or factual information you are unsure about, then answer concisely "
+        "and mention where the information came from."
+    )
+)
+
+def build_prompt(
+    messages: list[BaseMessage], summary: str = "", summarized: int = 0
+) -> list[BaseMessage]:
+    """Assemble [SYSTEM, summary, *history] for the LLM call.
+
+    The first `summarized` messages are represented by `summary` instead of being sent.
+    """
+    prefix = [SYSTEM]
+    if summary:
+        prefix.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    return [*prefix, *close_tool_calls(messages[summarized:])]
+
+# A turn can end on a tool call that never got its result: the tool limit was hit on
+# a replayed response, or the turn was interrupted (Ctrl-C) mid-search. The history is
+# checkpointed, so the API would reject every later prompt in that thread. Each such
+# call is answered with a stub ToolMessage when the prompt is built.
+TOOL_LIMIT_STUB = "tool limit reached"
+
+def close_tool_calls(history: list[BaseMessage]) -> list[BaseMessage]:
+    """Return history with a stub result after every tool call that has none."""
+    answered = {m.tool_call_id for m in history if isinstance(m, ToolMessage)}
+    closed = []
+    for m in history:
+        closed.append(m)
+        closed.extend(
+            ToolMessage(content=TOOL_LIMIT_STUB, tool_call_id=tc["id"], status="error")
+            for tc in getattr(m, "tool_calls", None) or []
+            if tc["id"] not in answered
+        )
+    return closed
+
+# --- HISTORY COMPACTION ---
+# Without a budget every turn re-sends the whole conversation. Once the prompt grows
+# past COMPACT_TOKEN_BUDGET, older turns are folded into a running summary and only
+# the last KEEP_TURNS turns are sent verbatim. The summary only changes when another
+# compaction happens, so between compactions the prompt prefix stays byte-stable.
+COMPACT_TOKEN_BUDGET = 6000
+KEEP_TURNS = 2  # the current turn + the one before it
+SUMMARIZER_TAG = "summarizer"  # lets stream_turn skip the summary's tokens
+
+SUMMARY_PROMPT = SystemMessage(
+    content=(
+        "Summarize the conversation below for an assistant that will continue it. "
+        "Keep facts, numbers, sources and open questions; drop small talk. "
+        "If a previous summary is given, merge it into the new one."
+    )
+)
+
+@functools.lru_cache(maxsize=1)
+def get_summarizer():
+    return get_llm().with_config(tags=[SUMMARIZER_TAG])
+
+# tiktoken downloads its encoding on first use, which blocks and fails offline. The
+# counter is picked once (in a worker thread, see compact_history); without the
+# encoding, prompts are estimated from their length instead.
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(messages: list[BaseMessage]) -> int:
+    return len(get_buffer_string(messages)) // CHARS_PER_TOKEN
+
+@functools.lru_cache(maxsize=1)
+def get_token_counter():
+    """llm.get_num_tokens_from_messages if tiktoken's encoding loads, else estimate_tokens."""
+    llm = get_llm()
+    try:
+        llm.get_num_tokens_from_messages([SYSTEM])
+    except Exception:
+        return estimate_tokens
+    return llm.get_num_tokens_from_messages
+
+def count_tokens(messages: list[BaseMessage]) -> int:
+    """Token count of a prompt. Blocking: call it through asyncio.to_thread."""
+    return get_token_counter()(messages)
+
+async def compact_history(state: "AgentState") -> dict:
+    """Fold old turns into the summary if the prompt is over budget.
+
+    Returns the state update ({"summary", "summarized"}), or {} if nothing changed.
+    """
+    messages = state['messages']
+    summary = state.get('summary', "")
+    summarized = state.get('summarized', 0)
+    prompt = build_prompt(messages, summary, summarized)
+    if await asyncio.to_thread(count_tokens, prompt) <= COMPACT_TOKEN_BUDGET:
+        return {}
+
+    # Cut on a turn boundary so a tool call is never separated from its result
+    turn_starts = [
+        i for i, m in enumerate(messages) if i >= summarized and isinstance(m, HumanMessage)
+    ]
+    if len(turn_starts) <= KEEP_TURNS:
+        return {}
+    cut = turn_starts[-KEEP_TURNS]
+
+    transcript = get_buffer_string(messages[summarized:cut])
+    if summary:
+        transcript = f"Previous summary:\n{summary}\n\nNew messages:\n{transcript}"
+    result = await get_summarizer().ainvoke([SUMMARY_PROMPT, HumanMessage(content=transcript)])
+    return {"summary": result.content, "summarized": cut}
+
+# --- STEP 3: THE STATE ---
+def merge_search_results(left: dict, right: dict | None) -> dict:
+    """Reducer for search_results: combine per-provider results, or clear on None."""
+    if right is None:
+        return {}
+    merged = {call_id: dict(by_provider) for call_id, by_provider in left.items()}
+    for call_id, by_provider in right.items():
+        merged.setdefault(call_id, {}).update(by_provider)
+    return merged
+
+class AgentState(TypedDict):
+    # This is the 'shared notebook' that keeps history. add_messages appends new
+    # messages (giving each an id) and replaces any whose id is already present
+    messages: Annotated[list[BaseMessage], add_messages]
+    # Running summary of messages[:summarized] (see compact_history)
+    summary: str
+    summarized: int
+    # Tool rounds used for the current question; call_mimo resets it for each new question
+    tool_iters: int
+    # Search results waiting to be merged: {tool_call_id: {provider: text}}
+    search_results: Annotated[dict, merge_search_results]
+
+# --- STEP 4: THE NODES ---
+async def call_mimo(state: AgentState):
+    """This function represents the 'Thinking' node."""
+    messages = state['messages']
+    # A new question gets a fresh tool budget
+    reset = {"tool_iters": 0} if isinstance(messages[-1], HumanMessage) else {}
+    tool_iters = reset.get("tool_iters", state.get("tool_iters", 0))
+
+    # Exact repeat of an earlier prompt: replay its response
+    prefix_cache = get_prefix_cache()
+    key = prefix_key(build_prompt(messages, state.get("summary", ""), state.get("summarized", 0)))
+    if (cached := prefix_cache.get(key)) is not None:
+        return {"messages": [cached], **reset}
+
+    # Only a standalone question (the first in its thread) is looked up or stored: an
+    # answer to a follow-up like "and in 2023?" depends on the conversation before it
+    semantic_cache = await asyncio.to_thread(get_semantic_cache)
+    last_human = next((m for m in reversed(messages) if isinstance(m, HumanMessage)), None)
+    emb = None
+    if semantic_cache is not None and last_human is messages[0]:
+        try:
+            emb = await semantic_cache.embed_async(last_human.content)
+        except Exception:
+            pass  # treated as a cache miss
+
+    # Only a fresh question can be answered from the cache (not a tool follow-up)
+    if emb is not None and isinstance(messages[-1], HumanMessage):
+        cached = semantic_cache.lookup(emb)
+        if cached is not None:
+            return {"messages": [AIMessage(content=cached.content)], **reset}
+
+    # Keep the prompt within budget before paying for the call
+    compaction = await compact_history(state)
+    prompt = build_prompt(
+        messages,
+        compaction.get("summary", state.get("summary", "")),
+        compaction.get("summarized", state.get("summarized", 0)),
+    )
+
+    # We tell MiMo to look at the messages and decide what to say. Once the tool limit
+    # is reached no tools are bound, so this round has to answer in text.
+    # Streaming lets the REPL print tokens as they arrive (see stream_turn).
+    llm = get_llm_with_tools() if tool_iters < MAX_TOOL_CALLS else get_llm()
+    chunks = []
+    async for chunk in llm.astream(prompt):
+        chunks.append(chunk)
+    response = message_chunk_to_message(sum(chunks[1:], chunks[0]))
+    prefix_cache.set(key, response)
+    if emb is not None:
+        semantic_cache.add(emb, response)
+    return {"messages": [response], **compaction, **reset}
+
+# Search nodes: every tool call is sent to BOTH providers in parallel (fan-out),
+# then merge_results joins their answers into one ToolMessage per call. Retrieval
+# takes as long as the slower provider, and the answer draws on both sources.
+PROVIDERS = {"tavily_node": "Tavily", "ddg_node": "DuckDuckGo"}
+
+async def run_provider(node: str, state: AgentState) -> dict:
+    """Run each pending tool call's query against one provider, concurrently."""
+    label = PROVIDERS[node]
+    tool = get_search_tools()[label]
+    calls = state['messages'][-1].tool_calls
+    coros = [tool.ainvoke({"query": c['args'].get('query', '')}) for c in calls]
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    return {"search_results": {
+        c['id']: {label: format_result(r)} for c, r in zip(calls, results)
+    }}
+
+def format_result(result) -> str:
+    """Tool output as text for the LLM: structured results become JSON (via orjson)."""
+    if isinstance(result, Exception):
+        return f"error: {result}"
+    if isinstance(result, str):
+        return result
+    return orjson.dumps(result).decode()
+
+async def tavily_only_node(state: AgentState):
+    return await run_provider("tavily_node", state)
+
+async def ddg_only_node(state: AgentState):
+    return await run_provider("ddg_node", state)
+
+def merge_results(state: AgentState):
+    """Join both providers' results into one ToolMessage per tool call."""
+    calls = state['messages'][-1].tool_calls
+    results = state.get("search_results", {})
+    messages = []
+    for c in calls:
+        by_provider = results.get(c['id'], {})
+        sections = [
+            f"[{label}]\n{by_provider[label]}"
+            for label in PROVIDERS.values() if label in by_provider
+        ]
+        failed = all(text.startswith("error: ") for text in by_provider.values())
+        messages.append(ToolMessage(
+            content="\n\n".join(sections),
+            tool_call_id=c['id'],
+            status="error" if failed else "success",
+        ))
+    # Passing None clears search_results for the next round
+    return {"messages": messages, "search_results": None,
+            "tool_iters": state.get("tool_iters", 0) + 1}
+
+# Limit tool rounds per question to prevent infinite loops. The count lives in the
+# state (not a global), so concurrent sessions don't interfere with each other.
+MAX_TOOL_CALLS = 3
+# LangGraph step budget for one question: each tool round is three steps (agent, the
+# parallel search nodes, merge), plus the final agent call and one step of headroom
+RECURSION_LIMIT = 3 * MAX_TOOL_CALLS + 2
+
+# Routing table, built once: True fans out to both search nodes, False ends the turn
+ROUTES = {True: list(PROVIDERS), False: END}
+
+# Conditional function to check if we should use tools
+def should_continue(state: AgentState):
+    """Decide whether to use tools or end."""
+    # If the LLM made a tool call, route to tools (but limit iterations)
+    wants_tools = bool(getattr(state['messages'][-1], "tool_calls", None))
+    return ROUTES[wants_tools and state.get("tool_iters", 0) < MAX_TOOL_CALLS]
+
+# --- STEP 5: THE GRAPH (FLOW) ---
+workflow = StateGraph(AgentState)
+
+# Add nodes to the graph
+workflow.add_node("agent", call_mimo)
+workflow.add_node("tavily_node", tavily_only_node)
+workflow.add_node("ddg_node", ddg_only_node)
+workflow.add_node("merge", merge_results)
+
+# Define the flow
+workflow.add_edge(START, "agent")
+workflow.add_conditional_edges("agent", should_continue, ["tavily_node", "ddg_node", END])
+workflow.add_edge(["tavily_node", "ddg_node"], "merge")  # waits for both searches
+workflow.add_edge("merge", "agent")  # After tools, go back to agent
+
+CHECKPOINT_DB = "agent.db"
+
+@functools.lru_cache(maxsize=1)
+def get_app():
+    """Compile the graph once per process, with a SQLite checkpointer.
+
+    The checkpointer binds to the running event loop, so call this from inside it.
+    The database connection is opened on first use.
+    """
+    # 'Compile' turns the map into an actual application
+    checkpointer = AsyncSqliteSaver(aiosqlite.connect(CHECKPOINT_DB))
+    return workflow.compile(checkpointer=checkpointer)
+
+async def aclose():
+    """Close the pooled connections and files opened by the runtime.
+
+    The getters are reset too, so a later event loop builds fresh objects instead of
+    reusing closed ones.
+    """
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+    if get_llm_http_client.cache_info().currsize:
+        await get_llm_http_client().aclose()
+    if get_prefix_cache.cache_info().currsize:
+        get_prefix_cache().disk.close()
+    if get_app.cache_info().currsize:
+        await get_app().checkpointer.conn.close()
+    # The model objects hold the closed LLM client, so they go as well
+    for getter in (get_http_client, get_llm_http_client, get_llm, get_llm_with_tools,
+                   get_summarizer, get_token_counter, get_prefix_cache, get_app):
+        getter.cache_clear()
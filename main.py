@@ -1,110 +1,200 @@
-import os
-import operator
-from typing import Annotated, TypedDict
-from dotenv import load_dotenv
-
-# 1. THE BRAIN & LOGIC IMPORTS
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
-from langgraph.graph import StateGraph, START, END
-from langgraph.prebuilt import ToolNode
-
-# 2. THE HANDS (TOOLS)
-from langchain_community.tools.tavily_search import TavilySearchResults
-from langchain_community.tools import DuckDuckGoSearchRun
-
-load_dotenv()
-
-# --- INITIALIZATION ---
-# This sets up your MiMo model
-llm = ChatOpenAI(
-    model="mimo-v2-flash", 
-    api_key=os.getenv("MIMO_API_KEY"),
-    base_url=os.getenv("MIMO_BASE_URL")
+import sys
+import uuid
+import asyncio
+import argparse
+from prompt_toolkit import PromptSession
+
+try:
+    # libuv-based event loop: less scheduling overhead for the concurrent HTTP work
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
+from langchain_core.messages import HumanMessage
+
+# Model, tools, caches and the graph live in agent_runtime; they're built once, on
+# first use, and shared by everything in the process
+from agent_runtime import (
+    get_app, aclose, warm_up, get_semantic_cache, SUMMARIZER_TAG, RECURSION_LIMIT,
 )
 
-tavily = TavilySearchResults(k=3)
-ddg = DuckDuckGoSearchRun()
-
-llm_with_tools = llm.bind_tools([tavily])
-
-# --- STEP 3: THE STATE ---
-class AgentState(TypedDict):
-    # This is the 'shared notebook' that keeps history
-    messages: Annotated[list[BaseMessage], operator.add]
-
-# --- STEP 4: THE NODES ---
-def call_mimo(state: AgentState):
-    """This function represents the 'Thinking' node."""
-    messages = state['messages']
-    # We tell MiMo to look at the messages and decide what to say
-    response = llm_with_tools.invoke(messages)
-    return {"messages": [response]}
-
-# Tool execution node
-tools = [tavily]
-tool_node = ToolNode(tools)
-
-# Track tool usage to prevent infinite loops
-tool_call_count = 0
-MAX_TOOL_CALLS = 3
-
-# Conditional function to check if we should use tools
-def should_continue(state: AgentState):
-    """Decide whether to use tools or end."""
-    global tool_call_count
-    last_message = state['messages'][-1]
-    
-    # If the LLM made a tool call, route to tools (but limit iterations)
-    if isinstance(last_message, AIMessage) and hasattr(last_message, 'tool_calls') and last_message.tool_calls:
-        if len(last_message.tool_calls) > 0 and tool_call_count < MAX_TOOL_CALLS:
-            tool_call_count += 1
-            return "tools"
-    
-    # Reset counter for next query and end
-    tool_call_count = 0
-    return END
-
-# --- STEP 5: THE GRAPH (FLOW) ---
-workflow = StateGraph(AgentState)
-
-# Add nodes to the graph
-workflow.add_node("agent", call_mimo)
-workflow.add_node("tools", tool_node)
-
-# Define the flow
-workflow.add_edge(START, "agent")
-workflow.add_conditional_edges("agent", should_continue, ["tools", END])
-workflow.add_edge("tools", "agent")  # After tools, go back to agent
-
-# 'Compile' turns the map into an actual application
-app = workflow.compile()
+THREAD_ID = "repl-1"  # conversation to resume; delete agent.db to start fresh
 
 # --- STEP 6: EXECUTION ---
-if __name__ == "__main__":
-    print("--- Research Agent (type 'quit' to exit) ---\n")
-    
-    # Keep conversation history for multi-turn conversations
-    messages = []
-    
-    while True:
-        user_text = input("You: ").strip()
-        
+async def stream_turn(app, inputs: dict, config: dict) -> dict:
+    """Run the graph, printing MiMo's tokens as they stream. Returns the final state."""
+    streamed = False
+    final_state = None
+    async for event in app.astream_events(inputs, config=config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_stream" and SUMMARIZER_TAG not in event.get("tags", []):
+            token = event["data"]["chunk"].content
+            if token:
+                if not streamed:
+                    print("\nAgent: ", end="", flush=True)
+                    streamed = True
+                print(token, end="", flush=True)
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            # The root run finishing carries the final graph state
+            final_state = event["data"]["output"]
+
+    if streamed:
+        print("\n")
+    else:
+        # Nothing streamed (e.g. a semantic cache hit), so print the answer in one go
+        print(f"\nAgent: {final_state['messages'][-1].content}\n")
+    return final_state
+
+# --- BACKGROUND PRE-EMBEDDING ---
+# The REPL reads input with prompt_toolkit's prompt_async, so the event loop keeps
+# running while the user types. A short pause in typing starts embedding the current
+# text for the semantic cache; by the time Enter is pressed, the lookup for the final
+# question is usually already computed. Each keystroke cancels the pending attempt.
+# Only a thread's first question is looked up in the semantic cache (see call_mimo),
+# so pre-embedding is switched off once the REPL thread has history.
+PRE_EMBED_DEBOUNCE = 0.15  # seconds
+
+class PreEmbedder:
+    """Debounced, speculative embedding of the question being typed."""
+
+    def __init__(self):
+        self.task: asyncio.Task | None = None
+        self.enabled = True
+
+    def on_text_changed(self, buffer):
+        if self.task:
+            self.task.cancel()
+        if self.enabled:
+            self.task = asyncio.create_task(self.embed(buffer.text))
+
+    async def embed(self, text: str):
+        await asyncio.sleep(PRE_EMBED_DEBOUNCE)
+        if not text.strip():
+            return
+        try:
+            # The first call builds the cache (model download + load): keep it off the loop
+            semantic_cache = await asyncio.to_thread(get_semantic_cache)
+            if semantic_cache is not None:
+                await semantic_cache.embed_async(text)
+        except Exception:
+            pass  # speculative: call_mimo embeds the question itself if this fails
+
+# --- BATCH MODE ---
+# With --batch, questions are read from stdin (e.g. a piped file). Questions arriving
+# within MAX_WAIT_MS of each other are grouped into one app.abatch() call of up to
+# BATCH_SIZE, which runs them concurrently instead of one after another.
+BATCH_SIZE = 8
+MAX_WAIT_MS = 50
+
+async def batch_collector(app, queue: asyncio.Queue):
+    """Drain (question, future) pairs from the queue in batches until it yields None."""
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < BATCH_SIZE:
+            try:
+                item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                done = True
+                break
+            batch.append(item)
+
+        # Each question is independent, so each gets its own thread
+        inputs = [{"messages": [HumanMessage(content=q)]} for q, _ in batch]
+        configs = [
+            {"configurable": {"thread_id": f"batch-{uuid.uuid4().hex}"},
+             "recursion_limit": RECURSION_LIMIT, "max_concurrency": BATCH_SIZE}
+            for _ in batch
+        ]
+        results = await app.abatch(inputs, configs, return_exceptions=True)
+        # The threads are single-use; don't let them pile up in the checkpoint database
+        for config in configs:
+            await app.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+async def batch_printer(answers: asyncio.Queue):
+    """Print answers in the order the questions were asked."""
+    while (item := await answers.get()) is not None:
+        question, future = item
+        try:
+            result = await future
+            print(f"You: {question}\nAgent: {result['messages'][-1].content}\n")
+        except Exception as e:
+            print(f"You: {question}\nAgent: [error] {e}\n")
+
+async def run_batch(app):
+    """Read questions from stdin and answer them in coalesced batches."""
+    loop = asyncio.get_running_loop()
+    queue, answers = asyncio.Queue(), asyncio.Queue()
+    collector = asyncio.create_task(batch_collector(app, queue))
+    printer = asyncio.create_task(batch_printer(answers))
+
+    while line := await asyncio.to_thread(sys.stdin.readline):
+        user_text = line.strip()
         if user_text.lower() in ['quit', 'exit', 'q']:
-            print("Goodbye!")
             break
-        
         if not user_text:
             continue
+        future = loop.create_future()
+        await queue.put((user_text, future))
+        await answers.put((user_text, future))
+
+    await queue.put(None)
+    await answers.put(None)
+    await asyncio.gather(collector, printer)
+
+async def main(batch: bool = False):
+    # The checkpointer stores the conversation per thread, so each turn only sends the
+    # new question; LangGraph appends it to the saved history via the state reducer
+    app = get_app()
+    # Connect to MiMo in the background while the user types the first question
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        if batch:
+            await run_batch(app)
+            return
         
-        # Add user message to history
-        messages.append(HumanMessage(content=user_text))
+        print("--- Research Agent (type 'quit' to exit) ---\n")
+        config = {"configurable": {"thread_id": THREAD_ID},
+                  "recursion_limit": RECURSION_LIMIT}
+        session = PromptSession()
+        pre_embedder = PreEmbedder()
+        session.default_buffer.on_text_changed += pre_embedder.on_text_changed
         
-        # Run the agent with recursion limit
-        result = app.invoke({"messages": messages}, config={"recursion_limit": 10})
-        
-        # Update messages with full conversation (includes tool calls and responses)
-        messages = result["messages"]
-        
-        # Print the agent's final response
-        print(f"\nAgent: {messages[-1].content}\n")
+        while True:
+            # The next question can only hit the semantic cache if it starts the thread
+            snapshot = await app.aget_state(config)
+            pre_embedder.enabled = not snapshot.values.get("messages")
+            user_text = (await session.prompt_async("You: ")).strip()
+            
+            if user_text.lower() in ['quit', 'exit', 'q']:
+                print("Goodbye!")
+                break
+            
+            if not user_text:
+                continue
+            
+            # Run the agent with recursion limit, streaming the response as it's generated
+            inputs = {"messages": [HumanMessage(content=user_text)]}
+            await stream_turn(app, inputs, config)
+    finally:
+        warm_up_task.cancel()
+        await aclose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Research agent powered by MiMo")
+    parser.add_argument("--batch", action="store_true",
+                        help="read questions from stdin and answer them in batches")
+    args = parser.parse_args()
+    run = uvloop.run if uvloop else asyncio.run
+    run(main(batch=args.batch))